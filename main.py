@@ -1,40 +1,111 @@
 
 import os
+import asyncio
 from dotenv import load_dotenv
 
 load_dotenv()
-import json
+import re
 import logging
-from uuid import uuid4
-from threading import Thread
-from flask import Flask
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+import sqlite3
+import orjson
+import uvloop
+import redis.asyncio as aioredis
+from functools import lru_cache
+from threading import Lock
+from cachetools import TTLCache
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, ReactionTypeEmoji
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 
 # === CONFIG ===
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-DATA_FILE = "users.json"
+DB_FILE = "users.db"
+LEGACY_FILE = "users.json"
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
+SESSION_TTL = 600  # seconds a pending "send to" session stays open
+FLUSH_INTERVAL = 5  # seconds between batched user writes
+MAX_FORWARDS = 32  # forwards allowed in flight at once
+LINK_TEMPLATE = None  # "https://t.me/<bot>?start={token}", filled in once the bot is initialized
+MD2_ESCAPE = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})  # one-pass MarkdownV2 escaping
 
 # === DATABASE ===
-if os.path.exists(DATA_FILE):
-    with open(DATA_FILE, "r") as f:
-        users_db = json.load(f)
-else:
-    users_db = {}  # {username: {"id": int, "token": str}}
+db = sqlite3.connect(DB_FILE, check_same_thread=False)
+db.execute("PRAGMA journal_mode=WAL")
+db.execute("PRAGMA synchronous=NORMAL")
+db.execute("CREATE TABLE IF NOT EXISTS users(username TEXT PRIMARY KEY, id INTEGER, token TEXT)")
+db.execute("CREATE INDEX IF NOT EXISTS idx_token ON users(token)")
+db_lock = Lock()  # the connection is shared by asyncio.to_thread workers
 
-messages_db = {}  # temporary {message_id: {"from": id, "to": id}}
+# One-time import of the old users.json store
+if os.path.exists(LEGACY_FILE) and not db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+    with open(LEGACY_FILE, "rb") as f:
+        legacy = orjson.loads(f.read())  # {username: {"id": int, "token": str}}
+    db.executemany(
+        "INSERT OR REPLACE INTO users VALUES (?,?,?)",
+        [(username, data["id"], data["token"]) for username, data in legacy.items()]
+    )
+    db.commit()
+
+# In-memory indexes; SQLite stays the source of truth on disk
+users_db = {  # {username: {"id": int, "token": str}}
+    username: {"id": user_id, "token": token}
+    for username, user_id, token in db.execute("SELECT username, id, token FROM users")
+}
+tokens_db = {data["token"]: username for username, data in users_db.items()}  # {token: username}
+
+# Pending "send to" sessions, shared across restarts and workers: target:{user_id} -> recipient id
+sessions = aioredis.from_url(REDIS_URL, decode_responses=True)
+
+def session_key(user_id):
+    return f"target:{user_id}"
+
+async def open_session(user_id, target_id):
+    await sessions.set(session_key(user_id), target_id, ex=SESSION_TTL)
+
+messages_db = TTLCache(maxsize=100_000, ttl=7 * 24 * 3600)  # {message_id: {"from": id, "to": id}}, replies tracked for a week
 
 # === KEEP-ALIVE ===
-def run_flask():
-    app = Flask(__name__)
-    @app.route('/')
-    def home(): return "🟢 Bot is alive!"
-    app.run(host='0.0.0.0', port=8080)
+async def start_keep_alive(application: Application):
+    from aiohttp import web  # deferred: only needed once the bot is up
+
+    app_http = web.Application()
+    app_http.router.add_get('/', lambda request: web.Response(text="🟢 Bot is alive!"))
+    runner = web.AppRunner(app_http)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', 8080).start()
+    application.bot_data["http_runner"] = runner
+
+async def stop_keep_alive(application: Application):
+    runner = application.bot_data.pop("http_runner", None)
+    if runner:
+        await runner.cleanup()
 
-def save_db():
-    with open(DATA_FILE, "w") as f:
-        json.dump(users_db, f)
+# === PERSISTENCE ===
+pending_users = []  # [(username, id, token)] registered since the last flush
+
+def save_users(rows):
+    # Blocking: run through asyncio.to_thread
+    with db_lock:
+        db.executemany("INSERT OR REPLACE INTO users VALUES (?,?,?)", rows)
+        db.commit()
+
+async def flush_users():
+    global pending_users
+    if not pending_users:
+        return
+    rows, pending_users = pending_users, []
+    try:
+        await asyncio.to_thread(save_users, rows)
+    except sqlite3.Error as e:
+        logger.error(f"Saving users failed: {e}")
+        pending_users = rows + pending_users
+
+async def flush_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_users()
 
 # === COMMANDS ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -45,23 +116,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if user.username not in users_db:
-        users_db[user.username] = {
-            "id": user.id,
-            "token": str(uuid4())
-        }
-        save_db()
+        from uuid import uuid4  # deferred: only needed on registration
+        new_token = str(uuid4())
+        users_db[user.username] = {"id": user.id, "token": new_token}
+        tokens_db[new_token] = user.username
+        pending_users.append((user.username, user.id, new_token))
 
     # If accessed via inbox link
     if context.args:
-        token = context.args[0]
-        target = next((username for username, data in users_db.items() if data["token"] == token), None)
+        target = tokens_db.get(context.args[0])
 
         if target:
             target_id = users_db[target]["id"]
             if target_id == user.id:
                 await update.message.reply_text("ℹ️ This is *your own* inbox link. Share it to receive anonymous messages.", parse_mode="Markdown")
             else:
-                context.user_data["target_id"] = target_id
+                await open_session(user.id, target_id)
                 await update.message.reply_text(
                     "💬 Type your anonymous message below to send it!",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cancel")]])
@@ -69,7 +139,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
     # Default: show user their own inbox link
-    inbox_link = f"https://t.me/{context.bot.username}?start={users_db[user.username]['token']}"
+    inbox_link = LINK_TEMPLATE.format(token=users_db[user.username]["token"])
     await update.message.reply_text(
         f"🔐 *Your Anonymous Inbox*\n\n"
         f"Share this link to receive messages:\n`{inbox_link}`\n\n"
@@ -89,69 +159,129 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await forward(context, user.id, recipient, message)
             return
 
-    target_id = context.user_data.get("target_id")
+    # GETDEL reads and closes the one-time session in a single round-trip
+    target_id = await sessions.getdel(session_key(user.id))
     if target_id:
-        await forward(context, user.id, target_id, message)
-        context.user_data.pop("target_id", None)
+        await forward(context, user.id, int(target_id), message)
     else:
         await update.message.reply_text("❗ Use someone’s inbox link to send an anonymous message.")
 
-# === CALLBACK HANDLER ===
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# === CALLBACK HANDLERS ===
+async def cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    await query.edit_message_text("❌ Cancelled.")
+    await sessions.delete(session_key(update.effective_user.id))
 
-    if query.data == "cancel":
-        await query.edit_message_text("❌ Cancelled.")
-        context.user_data.pop("target_id", None)
-        return
-
-    if query.data.startswith("reply_"):
-        sender_id = int(query.data.split("_")[1])
-        context.user_data["target_id"] = sender_id
-        await query.message.reply_text("↩️ Type your anonymous reply below.")
+async def reply_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    sender_id = int(context.matches[0].group("sender"))
+    await open_session(update.effective_user.id, sender_id)
+    await query.message.reply_text("↩️ Type your anonymous reply below.")
 
 # === FORWARD FUNCTION ===
+@lru_cache(maxsize=4096)
+def reply_markup(from_id):
+    # Telegram objects are immutable, so one markup per sender can be reused
+    return InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Reply Anonymously", callback_data=f"reply_{from_id}")]])
+
+# Checked in this order; the first attribute that is set decides the type
+MESSAGE_TYPES = ("text", "photo", "video", "voice", "animation", "sticker")
+
+def get_message_type(msg: Message):
+    return next((kind for kind in MESSAGE_TYPES if getattr(msg, kind)), "unknown")
+
+PREFIX = {
+    "text": "📨 *Anonymous Message*\n\n",
+    "photo": "📨 *Anonymous Photo*\n\n",
+    "video": "📨 *Anonymous Video*\n\n",
+    "voice": "📨 *Anonymous Voice*\n\n",
+    "animation": "📨 *Anonymous GIF*\n\n",
+}
+
+def caption(msg: Message):
+    return (msg.caption or "").translate(MD2_ESCAPE)
+
+SENDERS = {
+    "text": lambda bot, to_id, msg, markup: bot.send_message(to_id, PREFIX["text"] + msg.text.translate(MD2_ESCAPE), reply_markup=markup, parse_mode="MarkdownV2"),
+    "photo": lambda bot, to_id, msg, markup: bot.send_photo(to_id, msg.photo[-1].file_id, caption=PREFIX["photo"] + caption(msg), reply_markup=markup, parse_mode="MarkdownV2"),
+    "video": lambda bot, to_id, msg, markup: bot.send_video(to_id, msg.video.file_id, caption=PREFIX["video"] + caption(msg), reply_markup=markup, parse_mode="MarkdownV2"),
+    "voice": lambda bot, to_id, msg, markup: bot.send_voice(to_id, msg.voice.file_id, caption=PREFIX["voice"] + caption(msg), reply_markup=markup, parse_mode="MarkdownV2"),
+    "animation": lambda bot, to_id, msg, markup: bot.send_animation(to_id, msg.animation.file_id, caption=PREFIX["animation"] + caption(msg), reply_markup=markup, parse_mode="MarkdownV2"),
+    "sticker": lambda bot, to_id, msg, markup: bot.send_sticker(to_id, msg.sticker.file_id, reply_markup=markup),
+}
+
+FORWARD_SEM = asyncio.Semaphore(MAX_FORWARDS)  # bounds fan-out now that updates run concurrently
+
 async def forward(context, from_id, to_id, msg: Message):
-    try:
-        markup = InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Reply Anonymously", callback_data=f"reply_{from_id}")]])
-
-        content = msg.caption or ""
-
-        if msg.text:
-            sent = await context.bot.send_message(to_id, f"📨 *Anonymous Message*\n\n{msg.text}", reply_markup=markup, parse_mode="Markdown")
-        elif msg.photo:
-            sent = await context.bot.send_photo(to_id, msg.photo[-1].file_id, caption=f"📨 *Anonymous Photo*\n\n{content}", reply_markup=markup, parse_mode="Markdown")
-        elif msg.video:
-            sent = await context.bot.send_video(to_id, msg.video.file_id, caption=f"📨 *Anonymous Video*\n\n{content}", reply_markup=markup, parse_mode="Markdown")
-        elif msg.voice:
-            sent = await context.bot.send_voice(to_id, msg.voice.file_id, caption=f"📨 *Anonymous Voice*\n\n{content}", reply_markup=markup, parse_mode="Markdown")
-        elif msg.animation:  # GIFs
-            sent = await context.bot.send_animation(to_id, msg.animation.file_id, caption=f"📨 *Anonymous GIF*\n\n{content}", reply_markup=markup, parse_mode="Markdown")
-        elif msg.sticker:
-            sent = await context.bot.send_sticker(to_id, msg.sticker.file_id, reply_markup=markup)
-        else:
-            await context.bot.send_message(from_id, "❌ Unsupported message type.")
-            return
+    async with FORWARD_SEM:
+        try:
+            # Reject unsupported types before building the markup or escaping anything
+            kind = get_message_type(msg)
+            if kind == "unknown":
+                await context.bot.send_message(from_id, "❌ Unsupported message type.")
+                return
+
+            sent = await SENDERS[kind](context.bot, to_id, msg, reply_markup(from_id))
+
+            messages_db[sent.message_id] = {"from": from_id, "to": to_id}
 
-        messages_db[sent.message_id] = {"from": from_id, "to": to_id}
-        await context.bot.send_message(from_id, "✅ Sent anonymously!")
+            # Confirm with a reaction on the sender's message; fall back to a silent reply
+            try:
+                await context.bot.set_message_reaction(chat_id=msg.chat_id, message_id=msg.message_id, reaction=[ReactionTypeEmoji("👍")])
+            except TelegramError:
+                await msg.reply_text("✅ Sent anonymously!", disable_notification=True)
 
-    except Exception as e:
-        logger.error(f"Forward failed: {e}")
-        await context.bot.send_message(from_id, "❌ Failed to deliver. Maybe the user blocked the bot?")
+        except Exception as e:
+            logger.error(f"Forward failed: {e}")
+            await context.bot.send_message(from_id, "❌ Failed to deliver. Maybe the user blocked the bot?")
+
+# === LIFECYCLE ===
+async def on_startup(application: Application):
+    global LINK_TEMPLATE
+    # initialize() has already fetched the bot via get_me()
+    LINK_TEMPLATE = f"https://t.me/{application.bot.username}?start={{token}}"
+    await start_keep_alive(application)
+    application.bot_data["flush_task"] = asyncio.create_task(flush_loop())
+
+async def on_shutdown(application: Application):
+    # run_polling() handles SIGTERM/SIGINT and ends up here, so nothing registered is lost
+    task = application.bot_data.pop("flush_task", None)
+    if task:
+        task.cancel()
+    await flush_users()
+    await sessions.aclose()
+    await stop_keep_alive(application)
 
 # === MAIN ===
 def main():
-    # Start Flask keep-alive server
-    Thread(target=run_flask, daemon=True).start()
+    # libuv-backed event loop; run_polling() picks it up through the policy
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
     # Build and run Telegram bot
-    app = Application.builder().token(os.getenv("BOT_TOKEN")).build()
+    app = (
+        Application.builder()
+        .token(os.getenv("BOT_TOKEN"))
+        # Persistent HTTP/2 pool shared by all API calls; getUpdates keeps its own long-poll connection
+        .request(HTTPXRequest(connection_pool_size=64, http_version="2", read_timeout=10, connect_timeout=5))
+        .get_updates_request(HTTPXRequest(http_version="2", connect_timeout=5))
+        # Keeps every API call under Telegram's ~30 msg/s flood limit and retries 429s
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, max_retries=3))
+        # A slow upload to one chat must not hold up every other update
+        .concurrent_updates(True)
+        # Keep-alive server and user flushing run on the bot's event loop
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.ALL, handle_message))
+    app.add_handler(CallbackQueryHandler(cancel_callback, pattern="^cancel$"))
+    app.add_handler(CallbackQueryHandler(reply_callback, pattern=re.compile(r"^reply_(?P<sender>\d+)$")))
+    # Only message kinds forward() can deliver; everything else is dropped before dispatch
+    supported = filters.TEXT | filters.PHOTO | filters.VIDEO | filters.VOICE | filters.ANIMATION | filters.Sticker.ALL
+    app.add_handler(MessageHandler(supported, handle_message))
 
     logger.info("Bot is running...")
     app.run_polling()